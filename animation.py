@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import io
+import struct
+import zlib
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from PIL import Image
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+APNG_DISPOSE_OP_NONE = 0
+APNG_BLEND_OP_SOURCE = 0
+APNG_BLEND_OP_OVER = 1
+
+
+def iter_chunks(data: bytes) -> Iterator[Tuple[bytes, bytes]]:
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        yield chunk_type, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+
+def write_chunk(fp: BinaryIO, chunk_type: bytes, data: bytes) -> None:
+    fp.write(struct.pack('>I', len(data)))
+    fp.write(chunk_type)
+    fp.write(data)
+    fp.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def encode_png(image: Image.Image) -> Tuple[bytes, list]:
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    header = None
+    data = []
+    for chunk_type, chunk in iter_chunks(buffer.getvalue()):
+        if chunk_type == b'IHDR':
+            header = chunk
+        elif chunk_type == b'IDAT':
+            data.append(chunk)
+    return header, data
+
+
+def save_apng(fp: BinaryIO, frames: list, loop: Optional[int] = 0) -> None:
+    # frames: list of (image, (x, y), delay in ms). The first frame is the full canvas,
+    # the others are only the rectangles that changed and are alpha blended over the previous frame.
+    # All frames share the color type of IHDR, so everything is written as RGBA
+    sequence = 0
+    fp.write(PNG_SIGNATURE)
+    for num, (image, pos, delay) in enumerate(frames):
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        header, data = encode_png(image)
+        if num == 0:
+            write_chunk(fp, b'IHDR', header)
+            write_chunk(fp, b'acTL', struct.pack('>II', len(frames), loop))
+        write_chunk(fp, b'fcTL', struct.pack(
+            '>IIIIIHHBB',
+            sequence,
+            image.width,
+            image.height,
+            pos[0],
+            pos[1],
+            min(delay, 0xffff),
+            1000,
+            APNG_DISPOSE_OP_NONE,
+            APNG_BLEND_OP_SOURCE if num == 0 else APNG_BLEND_OP_OVER
+        ))
+        sequence += 1
+        for chunk in data:
+            if num == 0:
+                write_chunk(fp, b'IDAT', chunk)
+            else:
+                write_chunk(fp, b'fdAT', struct.pack('>I', sequence) + chunk)
+                sequence += 1
+    write_chunk(fp, b'IEND', b'')
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, Tuple
+
+import requests
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shops (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL UNIQUE,
+    date TEXT NOT NULL,
+    image TEXT
+);
+CREATE INDEX IF NOT EXISTS shops_date ON shops (date);
+CREATE TABLE IF NOT EXISTS sections (
+    shop INTEGER NOT NULL REFERENCES shops (id),
+    section_id TEXT NOT NULL,
+    name TEXT,
+    until TEXT,
+    PRIMARY KEY (shop, section_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS panels (
+    id INTEGER PRIMARY KEY,
+    offer_id TEXT NOT NULL UNIQUE,
+    name TEXT,
+    rarity_id TEXT,
+    series_id TEXT,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS panels_series ON panels (series_id);
+CREATE TABLE IF NOT EXISTS panel_versions (
+    id INTEGER PRIMARY KEY,
+    panel INTEGER NOT NULL REFERENCES panels (id),
+    hash TEXT NOT NULL,
+    data BLOB NOT NULL,
+    UNIQUE (panel, hash)
+);
+CREATE TABLE IF NOT EXISTS panel_items (
+    panel INTEGER NOT NULL REFERENCES panels (id),
+    item_id TEXT NOT NULL,
+    PRIMARY KEY (panel, item_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS panel_items_item ON panel_items (item_id);
+CREATE TABLE IF NOT EXISTS appearances (
+    shop INTEGER NOT NULL REFERENCES shops (id),
+    section_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    panel INTEGER NOT NULL REFERENCES panels (id),
+    version INTEGER REFERENCES panel_versions (id),
+    PRIMARY KEY (shop, section_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS appearances_panel ON appearances (panel, shop, version);
+CREATE TABLE IF NOT EXISTS assets (
+    url TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+# Fields that describe where a panel was placed rather than what it is
+PLACEMENT_FIELDS = ('section', 'priority', 'groupIndex')
+# Key of a panel version listing the fields of the base panel that the version does not have
+REMOVED_FIELDS = '-'
+
+
+def default(obj: Any) -> Any:
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    return obj
+
+
+def dump_json(obj: Any) -> bytes:
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+
+
+class AssetStore:
+    __slots__ = ('_directory',)
+
+    def __init__(self, directory: str) -> None:
+        self._directory = directory
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self._directory, digest[:2], digest)
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+
+class Archive:
+    __slots__ = ('_db', '_assets')
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'))
+        self._db.executescript(SCHEMA)
+        self._assets = AssetStore(os.path.join(directory, 'assets'))
+
+    def __enter__(self) -> 'Archive':
+        return self
+
+    def __exit__(self, *args: list) -> None:
+        self.close()
+
+    @property
+    def assets(self) -> AssetStore:
+        return self._assets
+
+    def close(self) -> None:
+        self._db.close()
+
+    def add(self, data: dict, image: Optional[bytes] = None,
+            session: Optional[requests.Session] = None) -> Optional[int]:
+        uid = dump_json(data['lastUpdate']).decode('utf-8')
+        if self._db.execute('SELECT 1 FROM shops WHERE uid = ?', (uid,)).fetchone() is not None:
+            return None
+
+        last_update = data['lastUpdate']
+        date = last_update.get('date') if isinstance(last_update, dict) else last_update
+        if not isinstance(date, str):
+            date = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        image_hash = None
+        if image is not None:
+            # The encoded file as written to disk, so it is stored and hashed without encoding it again
+            image_hash = self._assets.put(image)
+        if session is not None:
+            self.add_assets(data, session)
+
+        with self._db:
+            shop = self._db.execute('INSERT INTO shops (uid, date, image) VALUES (?, ?, ?)', (uid, date, image_hash)).lastrowid
+            for section in data['sections']:
+                until = section['until']
+                self._db.execute(
+                    'INSERT INTO sections (shop, section_id, name, until) VALUES (?, ?, ?, ?)',
+                    (shop, section['id'], section['name'], default(until))
+                )
+                for position, panel in enumerate(section['panels']):
+                    self._db.execute(
+                        'INSERT INTO appearances (shop, section_id, position, panel, version) VALUES (?, ?, ?, ?, ?)',
+                        (shop, section['id'], position, *self.add_panel(panel))
+                    )
+        return shop
+
+    def add_panel(self, panel: dict) -> Tuple[int, Optional[int]]:
+        # A panel is stored once per offer. Each appearance only keeps the fields that differ
+        # from the first one seen (price, banner, release dates...), deduplicated per offer
+        panel = json.loads(dump_json({k: v for k, v in panel.items() if k not in PLACEMENT_FIELDS}))
+        offer_id = panel.get('offerId') or panel.get('mainId')
+        row = self._db.execute('SELECT id, data FROM panels WHERE offer_id = ?', (offer_id,)).fetchone()
+        if row is None:
+            panel_id = self._db.execute(
+                'INSERT INTO panels (offer_id, name, rarity_id, series_id, data) VALUES (?, ?, ?, ?, ?)',
+                (
+                    offer_id,
+                    panel.get('displayName'),
+                    (panel.get('rarity') or {}).get('id'),
+                    (panel.get('series') or {}).get('id'),
+                    zlib.compress(dump_json(panel))
+                )
+            ).lastrowid
+            self.add_panel_items(panel_id, panel)
+            return panel_id, None
+
+        panel_id, base = row[0], json.loads(zlib.decompress(row[1]))
+        changes = {k: v for k, v in panel.items() if k not in base or base[k] != v}
+        removed = sorted(k for k in base if k not in panel)
+        if removed:
+            changes[REMOVED_FIELDS] = removed
+        if not changes:
+            return panel_id, None
+        data = dump_json(changes)
+        version_hash = hashlib.sha256(data).hexdigest()
+        cursor = self._db.execute(
+            'INSERT OR IGNORE INTO panel_versions (panel, hash, data) VALUES (?, ?, ?)',
+            (panel_id, version_hash, zlib.compress(data))
+        )
+        if not cursor.rowcount:
+            return panel_id, self._db.execute(
+                'SELECT id FROM panel_versions WHERE panel = ? AND hash = ?',
+                (panel_id, version_hash)
+            ).fetchone()[0]
+        self._db.execute(
+            'UPDATE panels SET name = ?, rarity_id = ?, series_id = ? WHERE id = ?',
+            (
+                panel.get('displayName'),
+                (panel.get('rarity') or {}).get('id'),
+                (panel.get('series') or {}).get('id'),
+                panel_id
+            )
+        )
+        self.add_panel_items(panel_id, panel)
+        return panel_id, cursor.lastrowid
+
+    def add_panel_items(self, panel_id: int, panel: dict) -> None:
+        self._db.executemany(
+            'INSERT OR IGNORE INTO panel_items (panel, item_id) VALUES (?, ?)',
+            [(panel_id, item['id']) for item in panel.get('granted', []) if item.get('id')]
+        )
+
+    def add_assets(self, data: dict, session: requests.Session) -> None:
+        urls = {
+            asset[key]
+            for section in data['sections']
+            for panel in section['panels']
+            for asset in panel.get('displayAssets', [])
+            for key in ('background', 'url')
+            if asset.get(key)
+        }
+        known = set()
+        for url in urls:
+            if self._db.execute('SELECT 1 FROM assets WHERE url = ?', (url,)).fetchone() is not None:
+                known.add(url)
+        urls -= known
+
+        def download(url: str) -> Optional[bytes]:
+            res = session.get(url)
+            if res.status_code != 200:
+                print(f'Failed to download asset {url}', file=sys.stderr)
+                return None
+            return res.content
+
+        with ThreadPoolExecutor() as executor:
+            futures = {url: executor.submit(download, url) for url in urls}
+        with self._db:
+            for url, future in futures.items():
+                try:
+                    content = future.result()
+                except Exception:
+                    print(f'Failed to download asset {url}', file=sys.stderr)
+                    continue
+                if content is not None:
+                    self._db.execute('INSERT INTO assets (url, hash) VALUES (?, ?)', (url, self._assets.put(content)))
+
+    def get_panel(self, offer_id: str, version: Optional[int] = None) -> dict:
+        data, = self._db.execute('SELECT data FROM panels WHERE offer_id = ?', (offer_id,)).fetchone()
+        panel = json.loads(zlib.decompress(data))
+        if version is not None:
+            data, = self._db.execute('SELECT data FROM panel_versions WHERE id = ?', (version,)).fetchone()
+            changes = json.loads(zlib.decompress(data))
+            for key in changes.pop(REMOVED_FIELDS, []):
+                del panel[key]
+            panel.update(changes)
+        return panel
+
+    def get_asset(self, url: str) -> Optional[bytes]:
+        row = self._db.execute('SELECT hash FROM assets WHERE url = ?', (url,)).fetchone()
+        return self._assets.get(row[0]) if row is not None else None
+
+    def _appearances(self, where: str, args: tuple, limit: Optional[int] = None) -> list:
+        query = f'''
+            SELECT shops.date, appearances.section_id, panels.offer_id, panels.name, appearances.version
+            FROM panels
+            JOIN appearances ON appearances.panel = panels.id
+            JOIN shops ON shops.id = appearances.shop
+            WHERE {where}
+            ORDER BY shops.date DESC
+        '''
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
+        return [
+            {'date': date, 'section': section_id, 'offerId': offer_id, 'name': name, 'version': version}
+            for date, section_id, offer_id, name, version in self._db.execute(query, args)
+        ]
+
+    def item_appearances(self, item_id: str, limit: Optional[int] = None) -> list:
+        return self._appearances(
+            'panels.id IN (SELECT panel FROM panel_items WHERE item_id = ?)',
+            (item_id,),
+            limit
+        )
+
+    def last_appearance(self, item_id: str) -> Optional[dict]:
+        appearances = self.item_appearances(item_id, 1)
+        return appearances[0] if appearances else None
+
+    def offer_appearances(self, offer_id: str, limit: Optional[int] = None) -> list:
+        return self._appearances('panels.offer_id = ?', (offer_id,), limit)
+
+    def series_appearances(self, series_id: str, limit: Optional[int] = None) -> list:
+        return self._appearances('panels.series_id = ?', (series_id,), limit)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Query or fill the shop archive')
+    parser.add_argument('--path', default='archive', help='archive directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparser = subparsers.add_parser('import', help='import shop.json files written by index.py')
+    subparser.add_argument('files', nargs='+')
+    for name in ('item', 'offer', 'series'):
+        subparser = subparsers.add_parser(name, help=f'list appearances of a {name}, newest first')
+        subparser.add_argument('id')
+        subparser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    with Archive(args.path) as archive:
+        if args.command == 'import':
+            for filename in args.files:
+                with open(filename, encoding='utf-8') as f:
+                    shop = archive.add(json.load(f))
+                print(f'{filename}: {"already archived" if shop is None else "imported"}')
+        else:
+            func = getattr(archive, f'{args.command}_appearances')
+            for appearance in func(args.id, args.limit):
+                print(f"{appearance['date']}\t{appearance['section']}\t{appearance['offerId']}\t{appearance['name']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Future, InvalidStateError
+from multiprocessing.connection import Client, Connection, Listener, wait
+from typing import Any, Callable, Optional, Tuple
+
+
+class WorkerError(Exception):
+    pass
+
+
+def resolve(future: Future, result: Any = None, exception: Optional[BaseException] = None) -> None:
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        # The caller cancelled the future (e.g. after a timeout) while the job was running
+        pass
+
+
+class Coordinator:
+    __slots__ = ('_listener', '_authkey', '_jobs', '_handlers', '_lock', '_closed', '_alive', '_max_attempts',
+                 '_local_workers', '_supervisor')
+
+    def __init__(self, address: Tuple[str, int], authkey: bytes, max_attempts: Optional[int] = 3) -> None:
+        self._listener = Listener(address, authkey=authkey)
+        self._authkey = authkey
+        self._jobs = queue.Queue()
+        self._handlers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # Number of connected workers
+        self._alive = 0
+        self._max_attempts = max_attempts
+        self._local_workers = []
+        self._supervisor = None
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def __enter__(self) -> 'Coordinator':
+        return self
+
+    def __exit__(self, *args: list) -> None:
+        self.close()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._listener.address
+
+    @property
+    def has_workers(self) -> bool:
+        # Local workers count even while they are (re)starting, they will pick up the queued jobs
+        return bool(self._alive or self._local_workers)
+
+    def submit(self, job: Any) -> Future:
+        # Jobs wait in the queue until a worker takes them, even if none is connected yet
+        future = Future()
+        self._jobs.put([job, future, 0])
+        return future
+
+    def start_local_workers(self, count: int, handler: Callable[[Any], Any]) -> None:
+        if count <= 0:
+            return
+        host, port = self.address
+        address = ('127.0.0.1' if host == '0.0.0.0' else host, port)
+
+        def spawn() -> multiprocessing.Process:
+            # A forked child could inherit locks held by the coordinator threads (e.g. the import lock
+            # during a handshake) and hang, so start a fresh interpreter like on Windows
+            process = multiprocessing.get_context('spawn').Process(target=run_worker, args=(address, self._authkey, handler))
+            process.start()
+            return process
+
+        def supervise() -> None:
+            # Restart local workers that died (e.g. killed by a job) so the coordinator never runs out of them
+            while True:
+                wait([process.sentinel for process in self._local_workers], timeout=1)
+                with self._lock:
+                    if self._closed:
+                        return
+                    for num, process in enumerate(self._local_workers):
+                        if process.exitcode is not None:
+                            print(f'Local worker exited with code {process.exitcode}, restarting it', file=sys.stderr)
+                            self._local_workers[num] = spawn()
+
+        self._local_workers.extend(spawn() for _ in range(count))
+        self._supervisor = threading.Thread(target=supervise, daemon=True)
+        self._supervisor.start()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _ in self._handlers:
+                self._jobs.put(None)
+        if self._supervisor is not None:
+            self._supervisor.join()
+        for handler in self._handlers:
+            handler.join()
+        # Every connected worker has been told to stop, local ones still starting up never got a job
+        for process in self._local_workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._listener.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            except Exception:
+                # Failed handshake (e.g. wrong authkey), keep listening
+                traceback.print_exc()
+                continue
+            with self._lock:
+                if self._closed:
+                    conn.close()
+                    return
+                handler = threading.Thread(target=self._handle, args=(conn,), daemon=True)
+                self._handlers.append(handler)
+                self._alive += 1
+                handler.start()
+
+    def _handle(self, conn: Connection) -> None:
+        with conn:
+            while True:
+                item = self._jobs.get()
+                if item is None:
+                    try:
+                        conn.send(None)
+                    except OSError:
+                        pass
+                    return
+                job, future, attempts = item
+                if future.cancelled():
+                    continue
+                try:
+                    conn.send(job)
+                except OSError:
+                    self._lost(item)
+                    return
+                except Exception as e:
+                    # Job could not be pickled
+                    resolve(future, exception=e)
+                    continue
+                try:
+                    ok, result = conn.recv()
+                except (EOFError, OSError):
+                    self._lost(item)
+                    return
+                if ok:
+                    resolve(future, result)
+                else:
+                    resolve(future, exception=WorkerError(result))
+
+    def _lost(self, item: list) -> None:
+        print('Lost connection to worker', file=sys.stderr)
+        job, future, attempts = item
+        with self._lock:
+            self._alive -= 1
+        if attempts + 1 >= self._max_attempts:
+            # The job itself probably kills the workers, do not hand it to anyone else
+            resolve(future, exception=WorkerError(f'Lost connection to worker {attempts + 1} times while running the job'))
+        else:
+            # Picked up by another worker, or by the next one that connects
+            self._jobs.put([job, future, attempts + 1])
+
+
+def run_worker(address: Tuple[str, int], authkey: bytes,
+               handler: Callable[[Any], Any],
+               retries: Optional[int] = 30) -> None:
+    for count in range(retries + 1):
+        try:
+            conn = Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if count == retries:
+                raise
+            time.sleep(1)
+        else:
+            break
+
+    with conn:
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                return
+            if job is None:
+                return
+            try:
+                result = (True, handler(job))
+            except Exception:
+                result = (False, traceback.format_exc())
+            try:
+                conn.send(result)
+            except OSError:
+                raise
+            except Exception:
+                # Result could not be pickled
+                conn.send((False, traceback.format_exc()))
@@ -1,4 +1,7 @@
+import contextlib
 import datetime
+import functools
+import io
 import itertools
 import json
 import sys
@@ -8,8 +11,12 @@ from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional, Tuple
 
 import requests
-from PIL import Image, ImageDraw
+from PIL import Image, ImageChops, ImageDraw
 
+from animation import save_apng
+from archive import Archive
+from cluster import Coordinator, run_worker
+from server import ShopServer, encode_variants
 from util import Fonts, ImageUtil, Language
 
 
@@ -30,6 +37,9 @@ PRICE_HEIGHT = 25
 RARITY_HEIGHT = 6
 SLOPE = 8
 VBUCKS_SLOPE = 15
+BANNER_HEIGHT = 32
+# Delay in ms between the timer frames of one second, browsers raise delays of 10 ms or less to 100 ms
+TIMER_FRAME_DELAY = 20
 
 with open('config.json', encoding='utf-8') as f:
     config = json.load(f)
@@ -38,61 +48,86 @@ name_fonts = Fonts([config['fonts']['ja'], -2], [config['fonts']['ko'], -2], [co
 langs = map(lambda x: x.name, Language.langs())
 if config['lang'] not in langs:
     raise ValueError(f"'lang' value must be one of {langs!r}")
+# Seconds to wait for the workers to render all sections of one shop image
+CLUSTER_TIMEOUT = config.get('cluster', {}).get('timeout', 300)
+
+
+USER_FACING_FLAG_PREFIX = 'Cosmetics.UserFacingFlags.'
+USER_FACING_FLAG_CONVERTER = {
+    'HasVariants': {
+        'matchMethod': 'full',
+        'image': 'variant_variant.png'
+    },
+    'HasUpgradeQuests': {
+        'matchMethod': 'full',
+        'image': 'variant_quest.png'
+    },
+    'Animated': {
+        'matchMethod': 'ends',
+        'image': 'variant_animated.png'
+    },
+    'Reactive': {
+        'matchMethod': 'starts',
+        'image': 'variant_adaptive.png'
+    },
+    'Traversal': {
+        'matchMethod': 'ends',
+        'image': 'variant_traversal.png'
+    },
+    'BuiltInEmote': {
+        'matchMethod': 'full',
+        'image': 'variant_builtincontent.png'
+    },
+    'Synced': {
+        'matchMethod': 'full',
+        'image': 'variant_synced.png'
+    },
+    'Enlightened': {
+        'matchMethod': 'full',
+        'image': 'variant_enlightened.png'
+    },
+    'GearUp': {
+        'matchMethod': 'full',
+        'image': 'variant_custom.png'
+    }
+}
+
+
+def compile_user_facing_flags(converter: dict) -> Tuple[frozenset, dict, dict]:
+    # Every rule of a method is found by looking up the tag's prefix/suffix of each rule length,
+    # so a tag matching several "starts" or "ends" rules gets all of their images
+    order = {flag: num for num, flag in enumerate(converter)}
+    full = frozenset(flag for flag, info in converter.items() if info['matchMethod'] == 'full')
+    rules = []
+    for method in ('starts', 'ends'):
+        flags = frozenset(flag for flag, info in converter.items() if info['matchMethod'] == method)
+        rules.append((tuple(sorted({len(flag) for flag in flags})), flags))
+    return full, dict(zip(('starts', 'ends'), rules)), order
+
+
+user_facing_flag_matcher = compile_user_facing_flags(USER_FACING_FLAG_CONVERTER)
 
 
-def get_user_facing_flag_images(item: dict) -> list:
+@functools.lru_cache(maxsize=None)
+def get_user_facing_flags(tags: Tuple[str, ...]) -> Tuple[str, ...]:
+    full, rules, order = user_facing_flag_matcher
     data = []
-    user_facing_flag_converter = {
-        'HasVariants': {
-            'matchMethod': 'full',
-            'image': 'variant_variant.png'
-        },
-        'HasUpgradeQuests': {
-            'matchMethod': 'full',
-            'image': 'variant_quest.png'
-        },
-        'Animated': {
-            'matchMethod': 'ends',
-            'image': 'variant_animated.png'
-        },
-        'Reactive': {
-            'matchMethod': 'starts',
-            'image': 'variant_adaptive.png'
-        },
-        'Traversal': {
-            'matchMethod': 'ends',
-            'image': 'variant_traversal.png'
-        },
-        'BuiltInEmote': {
-            'matchMethod': 'full',
-            'image': 'variant_builtincontent.png'
-        },
-        'Synced': {
-            'matchMethod': 'full',
-            'image': 'variant_synced.png'
-        },
-        'Enlightened': {
-            'matchMethod': 'full',
-            'image': 'variant_enlightened.png'
-        },
-        'GearUp': {
-            'matchMethod': 'full',
-            'image': 'variant_custom.png'
-        }
-    }
-    user_facing_flags = [tag[len('Cosmetics.UserFacingFlags.'):] for tag in item['gameplayTags'] if tag.startswith('Cosmetics.UserFacingFlags.')]
-    for user_facing_flag in user_facing_flags:
-        for flag, info in user_facing_flag_converter.items():
-            if info['matchMethod'] == 'full':
-                if user_facing_flag == flag:
-                    data.append(info['image'])
-            elif info['matchMethod'] == 'starts':
-                if user_facing_flag.startswith(flag):
-                    data.append(info['image'])
-            elif info['matchMethod'] == 'ends':
-                if user_facing_flag.endswith(flag):
-                    data.append(info['image'])
-    return data
+    for tag in tags:
+        if not tag.startswith(USER_FACING_FLAG_PREFIX):
+            continue
+        user_facing_flag = tag[len(USER_FACING_FLAG_PREFIX):]
+        flags = {user_facing_flag} if user_facing_flag in full else set()
+        lengths, starts = rules['starts']
+        flags.update(user_facing_flag[:length] for length in lengths if user_facing_flag[:length] in starts)
+        lengths, ends = rules['ends']
+        flags.update(user_facing_flag[-length:] for length in lengths if user_facing_flag[-length:] in ends)
+        data.extend(USER_FACING_FLAG_CONVERTER[flag]['image'] for flag in sorted(flags, key=order.get))
+    return tuple(data)
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_facing_flag_icon(filename: str) -> Image.Image:
+    return ImageUtil.ratio_resize(ImageUtil.open(filename).convert('RGBA'), 30, 30)
 
 
 def hex_color_to_tuple(color: str) -> tuple:
@@ -197,6 +232,12 @@ def get_section_width(section: dict) -> int:
     return size
 
 
+def get_section_height(section: dict) -> int:
+    if len(section['panels']) == 1 and section['panels'][0]['tileSize'] == 'Small':
+        return Y_MARGIN + SMALL_SIZE[1]
+    return Y_MARGIN + NORMAL_SIZE[1]
+
+
 def get_shop_size(data: dict, max_section_count: Optional[int] = 0) -> Tuple[int, int]:
     section_list = [data['sections'][i:i+max_section_count] for i in range(0, len(data['sections']), max_section_count)]
 
@@ -207,218 +248,377 @@ def get_shop_size(data: dict, max_section_count: Optional[int] = 0) -> Tuple[int
         sections_y = 0
         for section in sections:
             x_list.append(get_section_width(section))
-            if len(section['panels']) == 1 and section['panels'][0]['tileSize'] == 'Small':
-                sections_y += Y_MARGIN + SMALL_SIZE[1]
-            else:
-                sections_y += Y_MARGIN + NORMAL_SIZE[1]
+            sections_y += get_section_height(section)
         x += max(x_list) + SECTION_MARGIN
         y_list.append(sections_y)
     return MARGIN_LEFT + x + MARGIN_RIGHT, MARGIN_TOP + max(y_list) + MARGIN_BOTTOM
 
 
-def generate_image(data: dict, colors: dict, session: Optional[requests.Session] = requests.Session()) -> Image.Image:
-    print(f"Generating shop image with {len(data['sections'])} sections")
-    start = time.time()
-    now = datetime.datetime.now(datetime.timezone.utc)
+def get_max_section_count(data: dict) -> int:
     if config['max_section_count'] >= 1:
-        max_section_count = config['max_section_count']
+        return config['max_section_count']
     elif not config['max_section_count']:
-        max_section_count = len(data['sections'])
+        return len(data['sections'])
     else:
-        max_section_count = -(-len(data['sections']) // int(1 / config['max_section_count']))
-    image = Image.new('RGB', get_shop_size(data, max_section_count), (0, 80, 190))
+        return -(-len(data['sections']) // int(1 / config['max_section_count']))
 
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(generate_section, section, colors, now, session) for section in data['sections']]
 
+def get_section_positions(data: dict, max_section_count: int) -> list:
+    positions = []
     width = 0
     x = 0
     y = MARGIN_TOP
-    for count, future in enumerate(futures, 1):
+    for count, section in enumerate(data['sections'], 1):
+        positions.append((x, y))
+        section_width = get_section_width(section)
+        if section_width > width:
+            width = section_width
+        if (count % max_section_count) == 0:
+            x += width + SECTION_MARGIN
+            y = MARGIN_TOP
+            width = 0
+        else:
+            y += get_section_height(section)
+    return positions
+
+
+def generate_image(data: dict, colors: dict, session: Optional[requests.Session] = requests.Session(),
+                   coordinator: Optional[Coordinator] = None, timers: Optional[bool] = True) -> Tuple[Image.Image, int]:
+    # Also returns how many sections and panels failed and are missing from the image
+    print(f"Generating shop image with {len(data['sections'])} sections")
+    start = time.time()
+    now = datetime.datetime.now(datetime.timezone.utc) if timers else None
+    max_section_count = get_max_section_count(data)
+    image = Image.new('RGB', get_shop_size(data, max_section_count), (0, 80, 190))
+    positions = get_section_positions(data, max_section_count)
+
+    if coordinator is not None and not coordinator.has_workers:
+        print('No workers are connected, generating sections in this process', file=sys.stderr)
+        coordinator = None
+    if coordinator is None:
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(generate_section, section, colors, now, session) for section in data['sections']]
+    else:
+        futures = [
+            coordinator.submit({'section': section, 'colors': colors, 'now': now, 'pos': pos})
+            for section, pos in zip(data['sections'], positions)
+        ]
+
+    failed = 0
+    deadline = time.time() + CLUSTER_TIMEOUT
+    for pos, future in zip(positions, futures):
         try:
-            section_image = future.result()
+            section_image = future.result(timeout=max(deadline - time.time(), 0) if coordinator is not None else None)
         except Exception:
             print('Failed to generate section', file=sys.stderr)
             traceback.print_exc()
+            # Do not let a job that timed out keep a worker busy
+            future.cancel()
+            failed += 1
         else:
-            section_width = section_image.width - MARGIN_LEFT - MARGIN_RIGHT
-            if section_width > width:
-                width = section_width
-            image.paste(section_image, (x, y), section_image)
-            if (count % max_section_count) == 0:
-                x += width + SECTION_MARGIN
-                y = MARGIN_TOP
-                width = 0
+            if coordinator is not None:
+                pos = section_image['pos']
+                section_image, section_failed = Image.open(io.BytesIO(section_image['image'])), section_image['failed']
             else:
-                y += section_image.height
+                section_image, section_failed = section_image
+            image.paste(section_image, pos, section_image)
+            failed += section_failed
     end = time.time()
     print(f"Generated shop image in {end - start:.2f} seconds")
-    return image
+    if failed:
+        print(f'{failed} sections or panels could not be generated', file=sys.stderr)
+    return image, failed
 
 
-def generate_section(section: dict, colors: dict, now: datetime.datetime, session: Optional[requests.Session] = requests.Session()) -> Image.Image:
-    if len(section['panels']) == 1 and section['panels'][0]['tileSize'] == 'Small':
-        image = Image.new('RGBA', (MARGIN_LEFT + get_section_width(section) + MARGIN_RIGHT, Y_MARGIN + SMALL_SIZE[1]))
-    else:
-        image = Image.new('RGBA', (MARGIN_LEFT + get_section_width(section) + MARGIN_RIGHT, Y_MARGIN + NORMAL_SIZE[1]))
-    canvas = ImageDraw.Draw(image)
+def generate_timer_frames(data: dict, image: Image.Image, now: datetime.datetime, frame_count: int) -> list:
+    print(f'Generating {frame_count} timer frames')
+    start = time.time()
+    timers = []
+    for section, pos in zip(data['sections'], get_section_positions(data, get_max_section_count(data))):
+        if section['until'] is None:
+            continue
+        texts = [get_timer_text(section, now + datetime.timedelta(seconds=count)) for count in range(frame_count)]
+        fonts = name_fonts.fonts_size(25, 25, 25)
+        x = pos[0] + get_timer_text_x(section)
+        # Clipped to the section like generate_section does, and kept above the banners
+        box = (
+            x,
+            pos[1] + Y_MARGIN // 2 - 15,
+            min(x + max(fonts.text_size(text)[0] for text in texts) + 10, pos[0] + MARGIN_LEFT + get_section_width(section) + MARGIN_RIGHT),
+            pos[1] + Y_MARGIN - 15
+        )
+        if box[0] < box[2]:
+            timers.append((box, image.crop(box), texts))
+
+    def draw(clean: Image.Image, text: str) -> Image.Image:
+        patch = clean.copy()
+        write_timer_text(ImageDraw.Draw(patch), text, (0, -(Y_MARGIN // 2 - 15)))
+        return patch
+
+    # The static image gets the first frame of every timer. Every later second is one small frame per
+    # timer that changed, covering only its changed pixels (the others are transparent and keep the
+    # previous frame). A single frame spanning all timers would cover most of the canvas and take
+    # seconds to encode, so they are shown one after another with short delays and the last one
+    # takes the rest of the second
+    previous = []
+    for box, clean, texts in timers:
+        patch = draw(clean, texts[0])
+        image.paste(patch, box[:2])
+        previous.append(patch)
+    frames = [(image, (0, 0), 1000)]
+    for count in range(1, frame_count):
+        changed = []
+        for num, (box, clean, texts) in enumerate(timers):
+            patch = draw(clean, texts[count])
+            diff = ImageChops.difference(patch, previous[num])
+            previous[num] = patch
+            bbox = diff.getbbox()
+            if bbox is not None:
+                patch = patch.crop(bbox).convert('RGBA')
+                patch.putalpha(functools.reduce(ImageChops.lighter, diff.crop(bbox).split()).point(lambda v: 255 if v else 0))
+                changed.append((patch, (box[0] + bbox[0], box[1] + bbox[1])))
+        if not changed:
+            frame, pos, delay = frames[-1]
+            frames[-1] = (frame, pos, delay + 1000)
+            continue
+        for patch, pos in changed[:-1]:
+            frames.append((patch, pos, TIMER_FRAME_DELAY))
+        patch, pos = changed[-1]
+        frames.append((patch, pos, max(1000 - TIMER_FRAME_DELAY * (len(changed) - 1), TIMER_FRAME_DELAY)))
+    end = time.time()
+    print(f'Generated {len(frames)} timer frames in {end - start:.2f} seconds')
+    return frames
+
+
+def generate_section_job(job: dict) -> dict:
+    image, failed = generate_section(job['section'], job['colors'], job['now'])
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', compress_level=1)
+    return {'pos': job['pos'], 'image': buffer.getvalue(), 'failed': failed}
+
+
+def get_panel_positions(section: dict) -> list:
+    positions = []
+    x = MARGIN_LEFT
+    small_count = 0
+    for panel in section['panels']:
+        size = get_size(panel)
+        if panel['tileSize'] == 'Small':
+            small_count += 1
+            if small_count % 2 == 1:
+                positions.append((x, Y_MARGIN))
+                x += size[0] + X_MARGIN
+            else:
+                positions.append((x - size[0] - X_MARGIN, Y_MARGIN + (NORMAL_SIZE[1] - size[1] * 2) + size[1]))
+        else:
+            positions.append((x, Y_MARGIN))
+            x += size[0] + X_MARGIN
+    return positions
+
+
+@functools.lru_cache(maxsize=None)
+def get_timer_icon() -> Image.Image:
+    return ImageUtil.ratio_resize(
+        ImageUtil.open('shop_timer.png').convert('RGBA'),
+        50,
+        50
+    )
+
+
+def get_timer_text(section: dict, now: datetime.datetime) -> str:
+    end = section['until'] - now
+    m, s = divmod(end.seconds, 60)
+    h, m = divmod(m, 60)
+    return (
+        "{}:{:0>2}:{:0>2}".format(h, m, s)
+        if end > datetime.timedelta(hours=1) else
+        "{}:{:0>2}".format(m, s)
+    )
 
+
+def get_timer_text_x(section: dict) -> int:
     x = MARGIN_LEFT
     size = 50
     if section['name']:
         fonts = name_fonts.fonts_size(size, size, size)
-        x = 50
-        final_x, _ = fonts.write_text(canvas, section['name'].upper(), (x, Y_MARGIN // 2 - 25))
-        x += final_x
+        x = 50 + fonts.text_size(section['name'].upper())[0]
+    return x + 12 + get_timer_icon().width + 6
+
+
+def write_timer_text(canvas: ImageDraw.Draw, timer_text: str, pos: Tuple[int, int]) -> None:
+    size = 50
+    fonts = name_fonts.fonts_size(size // 2, size // 2, size // 2)
+    _, y = fonts.text_size(timer_text)
+    fonts.write_text(
+        canvas,
+        timer_text,
+        (pos[0], pos[1] + Y_MARGIN // 2 - 15 + y // 2),
+        fill=(115, 200, 235)
+    )
+
+
+def write_section_header(image: Image.Image, canvas: ImageDraw.Draw, section: dict, now: Optional[datetime.datetime]) -> None:
+    size = 50
+    if section['name']:
+        fonts = name_fonts.fonts_size(size, size, size)
+        fonts.write_text(canvas, section['name'].upper(), (50, Y_MARGIN // 2 - 25))
     if section['until'] is not None:
-        timer = ImageUtil.ratio_resize(
-            ImageUtil.open('shop_timer.png').convert('RGBA'),
-            size,
-            size
-        )
-        x += 12
+        timer = get_timer_icon()
+        x = get_timer_text_x(section)
         image.paste(
             timer,
-            (x, Y_MARGIN // 2 - 15 - 4),
+            (x - 6 - timer.width, Y_MARGIN // 2 - 15 - 4),
             timer
         )
+        # The timer text is left out when now is None so that it can be drawn per frame later
+        if now is not None:
+            write_timer_text(canvas, get_timer_text(section, now), (x, 0))
+
+
+def write_banner(image: Image.Image, canvas: ImageDraw.Draw, panel: dict, pos: Tuple[int, int], section_width: int) -> None:
+    font_size, minus = name_fonts.fit_fonts_size(
+        section_width - 25,
+        16,
+        panel['banner']['name']
+    )
+    fonts = name_fonts.fonts_size(font_size, font_size, font_size)
+    text_width = fonts.text_size(panel['banner']['name'])[0]
+    color = 'red' if panel['banner']['intensity'] == 'Low' else 'yellow'
+    banner_rear = ImageUtil.ratio_resize(ImageUtil.open(f'{color}_banner_rear.png').convert('RGBA'), 0, BANNER_HEIGHT, resample=Image.BICUBIC)
+    banner_middle = ImageUtil.open(f'{color}_banner_middle.png').convert('RGBA').resize((text_width, BANNER_HEIGHT))
+    banner_front = ImageUtil.ratio_resize(ImageUtil.open(f'{color}_banner_front.png').convert('RGBA'), 0, BANNER_HEIGHT, resample=Image.BICUBIC)
+    image.paste(
+        banner_rear,
+        (
+            pos[0] - 15,
+            pos[1] - 15
+        ),
+        banner_rear
+    )
+    image.paste(
+        banner_middle,
+        (
+            pos[0] - 15 + banner_rear.width,
+            pos[1] - 15
+        ),
+        banner_middle
+    )
+    image.paste(
+        banner_front,
+        (
+            pos[0] - 15 + banner_rear.width + banner_middle.width,
+            pos[1] - 15
+        ),
+        banner_front
+    )
+    fonts.write_text(
+        canvas,
+        panel['banner']['name'],
+        (pos[0] - 15 + banner_rear.width,
+         pos[1] - 15 + 5),
+        fill=(255, 255, 255) if panel['banner']['intensity'] == 'Low' else (0, 0, 0)
+    )
 
-        end = section['until'] - now
-        m, s = divmod(end.seconds, 60)
-        h, m = divmod(m, 60)
-        timer_text = (
-            "{}:{:0>2}:{:0>2}".format(h, m, s)
-            if end > datetime.timedelta(hours=1) else
-            "{}:{:0>2}".format(m, s)
-        )
-        x += timer.width + 6
-        fonts = name_fonts.fonts_size(size // 2, size // 2, size // 2)
-        _, y = fonts.text_size(timer_text)
-        fonts.write_text(
-            canvas,
-            timer_text,
-            (x, Y_MARGIN // 2 - 15 + y // 2),
-            fill=(115, 200, 235)
-        )
+
+def generate_section(section: dict, colors: dict, now: Optional[datetime.datetime], session: Optional[requests.Session] = requests.Session()) -> Tuple[Image.Image, int]:
+    image = Image.new('RGBA', (MARGIN_LEFT + get_section_width(section) + MARGIN_RIGHT, get_section_height(section)))
+    canvas = ImageDraw.Draw(image)
+    write_section_header(image, canvas, section, now)
 
     with ThreadPoolExecutor() as executor:
         futures = [executor.submit(generate_panel, panel, colors, session) for panel in section['panels']]
 
-    x = MARGIN_LEFT
-    small_count = 0
-    for num, future in enumerate(futures):
+    failed = 0
+    for panel, pos, future in zip(section['panels'], get_panel_positions(section), futures):
         try:
             panel_image = future.result()
         except Exception:
             print('Failed to generate panel', file=sys.stderr)
             traceback.print_exc()
+            failed += 1
         else:
-            panel = section['panels'][num]
-            size = get_size(panel)
-            if panel['tileSize'] == 'Small':
-                small_count += 1
-                if small_count % 2 == 1:
-                    pos = (x, Y_MARGIN)
-                    x += size[0] + X_MARGIN
-                else:
-                    pos = (x - size[0] - X_MARGIN, Y_MARGIN + (NORMAL_SIZE[1] - size[1] * 2) + size[1])
-            else:
-                pos = (x, Y_MARGIN)
-                x += size[0] + X_MARGIN
             image.paste(panel_image, pos)
             if panel['banner'] is not None:
-                font_size, minus = name_fonts.fit_fonts_size(
-                    image.width - 25,
-                    16,
-                    panel['banner']['name']
-                )
-                fonts = name_fonts.fonts_size(font_size, font_size, font_size)
-                text_width = fonts.text_size(panel['banner']['name'])[0]
-                banner_height = 32
-                color = 'red' if panel['banner']['intensity'] == 'Low' else 'yellow'
-                banner_rear = ImageUtil.ratio_resize(ImageUtil.open(f'{color}_banner_rear.png').convert('RGBA'), 0, banner_height, resample=Image.BICUBIC)
-                banner_middle = ImageUtil.open(f'{color}_banner_middle.png').convert('RGBA').resize((text_width, banner_height))
-                banner_front = ImageUtil.ratio_resize(ImageUtil.open(f'{color}_banner_front.png').convert('RGBA'), 0, banner_height, resample=Image.BICUBIC)
-                image.paste(
-                    banner_rear,
-                    (
-                        pos[0] - 15,
-                        pos[1] - 15
-                    ),
-                    banner_rear
-                )
-                image.paste(
-                    banner_middle,
-                    (
-                        pos[0] - 15 + banner_rear.width,
-                        pos[1] - 15
-                    ),
-                    banner_middle
-                )
-                image.paste(
-                    banner_front,
-                    (
-                        pos[0] - 15 + banner_rear.width + banner_middle.width,
-                        pos[1] - 15
-                    ),
-                    banner_front
-                )
-                fonts.write_text(
-                    canvas,
-                    panel['banner']['name'],
-                    (pos[0] - 15 + banner_rear.width,
-                     pos[1] - 15 + 5),
-                    fill=(255, 255, 255) if panel['banner']['intensity'] == 'Low' else (0, 0, 0)
-                )
+                write_banner(image, canvas, panel, pos, image.width)
 
-    return image
+    return image, failed
 
 
-def generate_panel(panel: dict, colors: dict, session: Optional[requests.Session] = requests.Session()) -> Image.Image:
-    image = Image.new('RGB', get_size(panel))
+@functools.lru_cache(maxsize=None)
+def get_vbucks_icon() -> Image.Image:
+    return ImageUtil.ratio_resize(
+        ImageUtil.open('vbucks.png').point(lambda x: x * 0.8).convert('RGBA').rotate(-15),
+        40,
+        40
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_panel_chrome(size: Tuple[int, int], color: Tuple[int, int, int]) -> Image.Image:
+    image = Image.new('RGBA', size)
     canvas = ImageDraw.Draw(image)
-    image2 = Image.new('RGBA', (image.width * 2, image.height * 2))
+    image2 = Image.new('RGBA', (size[0] * 2, size[1] * 2))
     canvas2 = ImageDraw.Draw(image2)
+
+    canvas.polygon(
+        ((0, size[1] - PRICE_HEIGHT), (size[0], size[1] - PRICE_HEIGHT),
+         (size[0], size[1]), (0, size[1])),
+        fill=(14, 14, 14)
+    )
+    vbucks = get_vbucks_icon()
+    layer = Image.new('RGBA', size)
+    layer.paste(vbucks, (size[0] - vbucks.width - 5, size[1] - vbucks.height + 10))
+    image.alpha_composite(layer)
+
+    canvas2.polygon(
+        ((0, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - RARITY_HEIGHT) * 2), (size[0] * 2, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - RARITY_HEIGHT - SLOPE) * 2),
+         (size[0] * 2, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - SLOPE) * 2), (0, (size[1] - PRICE_HEIGHT - NAME_HEIGHT) * 2)),
+        fill=color
+    )
+    canvas2.polygon(
+        ((0, (size[1] - PRICE_HEIGHT - NAME_HEIGHT) * 2), (size[0] * 2, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - SLOPE) * 2),
+         (size[0] * 2, (size[1] - PRICE_HEIGHT) * 2), (0, (size[1] - PRICE_HEIGHT) * 2)),
+        fill=(30, 30, 30)
+    )
+    image2.thumbnail(size, Image.LANCZOS)
+    image.alpha_composite(image2)
+    return image
+
+
+def generate_panel(panel: dict, colors: dict, session: Optional[requests.Session] = requests.Session()) -> Image.Image:
     size = get_size(panel)
     background = ImageUtil.ratio_resize(
         ImageUtil.get_image(panel['displayAssets'][0]['background'], session).convert('RGBA'),
         *size
     )
+    display_asset = ImageUtil.ratio_resize(
+        ImageUtil.get_image(panel['displayAssets'][0]['url'], session).convert('RGBA'),
+        *size
+    )
+    chrome = get_panel_chrome(size, colors[panel['series']['id'] if panel['series'] is not None else panel['rarity']['id']])
+
+    image = Image.new('RGB', size)
     image.paste(
         background,
         ImageUtil.center_x(background.width, image.width, 0),
         background
     )
-    display_asset = ImageUtil.ratio_resize(
-        ImageUtil.get_image(panel['displayAssets'][0]['url'], session).convert('RGBA'),
-        *size
-    )
     image.paste(
         display_asset,
         ImageUtil.center_x(display_asset.width, image.width, 0),
         display_asset
     )
-
-    canvas.polygon(
-        ((0, size[1] - PRICE_HEIGHT), (size[0], size[1] - PRICE_HEIGHT),
-         (size[0], size[1]), (0, size[1])),
-        fill=(14, 14, 14)
-    )
-    vbucks = ImageUtil.ratio_resize(
-        ImageUtil.open('vbucks.png').point(lambda x: x * 0.8).convert('RGBA').rotate(-15),
-        40,
-        40
-    )
-    pos = size[0] - vbucks.width - 5
     image.paste(
-        vbucks,
-        (pos, size[1] - vbucks.height + 10),
-        vbucks
+        chrome,
+        (0, 0),
+        chrome
     )
+    canvas = ImageDraw.Draw(image)
+
     text = f"{panel['price']['finalPrice']:,}"
     fonts = name_fonts.fonts_size(15, 15, 15)
     x, y = fonts.text_size(text)
-    pos = pos - x - 3
+    pos = size[0] - get_vbucks_icon().width - 5 - x - 3
     fonts.write_text(
         canvas,
         text,
@@ -437,28 +637,26 @@ def generate_panel(panel: dict, colors: dict, session: Optional[requests.Session
             (pos, size[1] - y - 4),
             fill=(100, 100, 100)
         )
+        # Only the strip around the line is supersampled, with room for the line width and the LANCZOS filter
+        box = (
+            max(pos - 2 - 4, 0),
+            max(size[1] - y - 4 + 6 - 4, 0),
+            min(pos + x + 3 + 4, size[0]),
+            min(size[1] - y - 4 + 10 + 4, size[1])
+        )
+        image2 = Image.new('RGBA', ((box[2] - box[0]) * 2, (box[3] - box[1]) * 2))
+        canvas2 = ImageDraw.Draw(image2)
         canvas2.line(
-            (((pos - 2) * 2, (size[1] - y - 4 + 10) * 2), ((pos + x + 3) * 2, (size[1] - y - 4 + 6) * 2)),
+            (((pos - 2 - box[0]) * 2, (size[1] - y - 4 + 10 - box[1]) * 2), ((pos + x + 3 - box[0]) * 2, (size[1] - y - 4 + 6 - box[1]) * 2)),
             fill=(100, 110, 110),
             width=3 * 2
         )
-
-    canvas2.polygon(
-        ((0, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - RARITY_HEIGHT) * 2), (size[0] * 2, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - RARITY_HEIGHT - SLOPE) * 2),
-         (size[0] * 2, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - SLOPE) * 2), (0, (size[1] - PRICE_HEIGHT - NAME_HEIGHT) * 2)),
-        fill=colors[panel['series']['id'] if panel['series'] is not None else panel['rarity']['id']]
-    )
-    canvas2.polygon(
-        ((0, (size[1] - PRICE_HEIGHT - NAME_HEIGHT) * 2), (size[0] * 2, (size[1] - PRICE_HEIGHT - NAME_HEIGHT - SLOPE) * 2),
-         (size[0] * 2, (size[1] - PRICE_HEIGHT) * 2), (0, (size[1] - PRICE_HEIGHT) * 2)),
-        fill=(30, 30, 30)
-    )
-    image2.thumbnail(image.size, Image.LANCZOS)
-    image.paste(
-        image2,
-        (0, 0),
-        image2
-    )
+        image2 = image2.resize((box[2] - box[0], box[3] - box[1]), Image.LANCZOS)
+        image.paste(
+            image2,
+            box[:2],
+            image2
+        )
 
     fonts = name_fonts.fonts_size(20, 20, 20)
     x, y = fonts.text_size(panel['displayName'])
@@ -470,8 +668,8 @@ def generate_panel(panel: dict, colors: dict, session: Optional[requests.Session
     )
 
     icons = [
-        ImageUtil.ratio_resize(ImageUtil.open(filename).convert('RGBA'), 30, 30)
-        for filename in set(itertools.chain(*[get_user_facing_flag_images(item) for item in panel['granted']]))
+        get_user_facing_flag_icon(filename)
+        for filename in dict.fromkeys(itertools.chain(*[get_user_facing_flags(tuple(item['gameplayTags'])) for item in panel['granted']]))
     ]
     x = size[0] - 10
     for icon in icons:
@@ -486,21 +684,119 @@ def generate_panel(panel: dict, colors: dict, session: Optional[requests.Session
     return image
 
 
+def render_shop(session: Optional[requests.Session] = requests.Session(),
+                coordinator: Optional[Coordinator] = None,
+                archive: Optional[Archive] = None,
+                data: Optional[dict] = None) -> Tuple[dict, Image.Image, Optional[bytes], int]:
+    # The last value is the number of sections and panels missing from the image
+    if data is None:
+        print('Getting shop data')
+        data = get_shop(session)
+    with open('shop.json', 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False, default=default)
+    colors = get_rarity_colors(session)
+    animation = config.get('animation', {'enabled': False})
+    if animation['enabled']:
+        image, failed = generate_image(data, colors, session, coordinator, timers=False)
+        frames = generate_timer_frames(data, image, datetime.datetime.now(datetime.timezone.utc), animation['frames'])
+        print('Saving animated image')
+        start = time.time()
+        buffer = io.BytesIO()
+        save_apng(buffer, frames, animation['loop'])
+        animated_image = buffer.getvalue()
+        with open('shop_animated.png', 'wb') as f:
+            f.write(animated_image)
+        end = time.time()
+        print(f'Successfully saved animated image in {end - start:.2f} seconds')
+    else:
+        image, failed = generate_image(data, colors, session, coordinator)
+        animated_image = None
+    print('Saving image')
+    start = time.time()
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    image_data = buffer.getvalue()
+    with open('shop.png', 'wb') as f:
+        f.write(image_data)
+    end = time.time()
+    print(f'Successfully saved image in {end - start:.2f} seconds')
+    if archive is not None and failed:
+        # Left for a later render of the same shop that succeeds
+        print('Not archiving an incomplete shop image', file=sys.stderr)
+    elif archive is not None:
+        print('Archiving shop')
+        start = time.time()
+        archive.add(data, image_data, session if config['archive']['download_assets'] else None)
+        end = time.time()
+        print(f'Successfully archived shop in {end - start:.2f} seconds')
+    return data, image, animated_image, failed
+
+
 def default(obj: Any) -> Any:
     if isinstance(obj, datetime.datetime):
         return obj.isoformat()
     return obj
 
 
-session = requests.Session()
-print('Getting shop data')
-data = get_shop(session)
-with open('shop.json', 'w', encoding='utf-8') as f:
-    json.dump(data, f, indent=4, ensure_ascii=False, default=default)
-colors = get_rarity_colors(session)
-image = generate_image(data, colors, session)
-print('Saving image')
-start = time.time()
-image.save('shop.png')
-end = time.time()
-print(f'Successfully saved image in {end - start:.2f} seconds')
+if __name__ == '__main__':
+    cluster = config.get('cluster', {'enabled': False})
+    if cluster['enabled'] or sys.argv[1:] == ['worker']:
+        if not cluster.get('authkey'):
+            raise ValueError("'cluster.authkey' must be set to use the cluster mode")
+        authkey = cluster['authkey'].encode()
+
+    if sys.argv[1:] == ['worker']:
+        print(f"Connecting to coordinator at {cluster['host']}:{cluster['port']}")
+        run_worker((cluster['host'], cluster['port']), authkey, generate_section_job)
+        sys.exit()
+
+    server = config.get('server', {'enabled': False})
+    archive_config = config.get('archive', {'enabled': False})
+    session = requests.Session()
+    with contextlib.ExitStack() as stack:
+        coordinator = None
+        if cluster['enabled']:
+            coordinator = stack.enter_context(Coordinator((cluster['host'], cluster['port']), authkey))
+            host, port = coordinator.address
+            print(f'Waiting for workers on {host}:{port}')
+            coordinator.start_local_workers(cluster['local_workers'], generate_section_job)
+        archive = None
+        if archive_config['enabled']:
+            archive = stack.enter_context(Archive(archive_config['path']))
+
+        if server['enabled']:
+            shop_server = stack.enter_context(ShopServer((server['host'], server['port'])))
+            shop_server.start()
+            host, port = shop_server.server_address[:2]
+            print(f'Serving shop on http://{host}:{port}/')
+            last_update = None
+            while True:
+                try:
+                    print('Getting shop data')
+                    data = get_shop(session)
+                    if data['lastUpdate'] == last_update:
+                        # Keep serving the same files so that clients polling with If-None-Match get 304
+                        print('Shop has not been updated since the last render')
+                    else:
+                        data, image, animated_image, failed = render_shop(session, coordinator, archive, data)
+                        print('Encoding image variants')
+                        start = time.time()
+                        files = encode_variants(image, 'shop', server['formats'], server['scales'])
+                        files['/shop.json'] = (
+                            json.dumps(data, indent=4, ensure_ascii=False, default=default).encode('utf-8'),
+                            'application/json; charset=utf-8'
+                        )
+                        if animated_image is not None:
+                            files['/shop_animated.png'] = (animated_image, 'image/apng')
+                        shop_server.update(files)
+                        end = time.time()
+                        print(f'Successfully updated served shop in {end - start:.2f} seconds')
+                        if not failed:
+                            # An incomplete image is served until the next interval renders the shop again
+                            last_update = data['lastUpdate']
+                except Exception:
+                    print('Failed to render shop', file=sys.stderr)
+                    traceback.print_exc()
+                time.sleep(server['interval'])
+        else:
+            render_shop(session, coordinator, archive)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import email.utils
+import hashlib
+import io
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+from PIL import Image
+
+
+IMAGE_FORMATS = {
+    'png': ('PNG', 'image/png', {}),
+    'webp': ('WEBP', 'image/webp', {'quality': 90, 'method': 4}),
+    'jpg': ('JPEG', 'image/jpeg', {'quality': 90}),
+}
+
+
+def encode_image(image: Image.Image, image_format: str, scale: Optional[float] = 1) -> bytes:
+    if scale != 1:
+        image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+    pil_format, _, params = IMAGE_FORMATS[image_format]
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format, **params)
+    return buffer.getvalue()
+
+
+def encode_variants(image: Image.Image, name: str, formats: list, scales: list) -> dict:
+    def path(image_format: str, scale: float) -> str:
+        return f'/{name}.{image_format}' if scale == 1 else f'/{name}@{scale:g}x.{image_format}'
+
+    with ThreadPoolExecutor() as executor:
+        futures = {
+            path(image_format, scale): (executor.submit(encode_image, image, image_format, scale), IMAGE_FORMATS[image_format][1])
+            for image_format in formats
+            for scale in scales
+        }
+    return {path: (future.result(), content_type) for path, (future, content_type) in futures.items()}
+
+
+class Resource:
+    __slots__ = ('_body', '_content_type', '_etag', '_last_modified')
+
+    def __init__(self, body: bytes, content_type: str, last_modified: float) -> None:
+        self._body = body
+        self._content_type = content_type
+        self._etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self._last_modified = last_modified
+
+    @property
+    def body(self) -> bytes:
+        return self._body
+
+    @property
+    def content_type(self) -> str:
+        return self._content_type
+
+    @property
+    def etag(self) -> str:
+        return self._etag
+
+    @property
+    def last_modified(self) -> float:
+        return self._last_modified
+
+
+class ShopRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'ShopBot'
+    range_pattern = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    def log_message(self, format: str, *args: list) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        self.handle_request(False)
+
+    def do_GET(self) -> None:
+        self.handle_request(True)
+
+    def handle_request(self, send_body: bool) -> None:
+        resources = self.server.resources
+        if not resources:
+            self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+            self.send_header('Retry-After', '10')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        resource = resources.get(self.path.split('?', 1)[0])
+        if resource is None:
+            self.send_response(HTTPStatus.NOT_FOUND)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.not_modified(resource):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_common_headers(resource)
+            self.end_headers()
+            return
+
+        body = resource.body
+        byte_range = self.get_range(resource)
+        if byte_range is None:
+            self.send_response(HTTPStatus.OK)
+        elif byte_range == ():
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{len(body)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        else:
+            start, end = byte_range
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+            body = body[start:end + 1]
+        self.send_common_headers(resource)
+        self.send_header('Content-Type', resource.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_common_headers(self, resource: Resource) -> None:
+        self.send_header('ETag', resource.etag)
+        self.send_header('Last-Modified', email.utils.formatdate(resource.last_modified, usegmt=True))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Accept-Ranges', 'bytes')
+
+    def not_modified(self, resource: Resource) -> bool:
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            return any(etag.startswith('W/') and etag[2:] == resource.etag or etag == resource.etag for etag in etags)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(resource.last_modified) <= since
+        return False
+
+    def get_range(self, resource: Resource) -> Optional[Tuple[int, ...]]:
+        # None: send the whole body, (): not satisfiable, (start, end): inclusive byte range
+        header = self.headers.get('Range')
+        if header is None:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != resource.etag:
+            return None
+        match = self.range_pattern.match(header.strip())
+        if match is None or match.groups() == ('', ''):
+            # Multiple or malformed ranges, ignore them
+            return None
+        length = len(resource.body)
+        first, last = match.groups()
+        if first == '':
+            start, end = max(length - int(last), 0), length - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                # Syntactically invalid range, ignore the header
+                return None
+            end = min(int(last), length - 1) if last else length - 1
+        if start >= length or start > end:
+            return ()
+        return start, end
+
+
+class ShopServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int]) -> None:
+        super().__init__(address, ShopRequestHandler)
+        self._resources = {}
+        self._thread = None
+
+    @property
+    def resources(self) -> dict:
+        return self._resources
+
+    def update(self, files: dict) -> None:
+        now = time.time()
+        resources = {}
+        for path, (body, content_type) in files.items():
+            resource = self._resources.get(path)
+            if resource is None or resource.body != body:
+                resource = Resource(body, content_type, now)
+            resources[path] = resource
+        # Replace the whole mapping at once so requests never see a half updated render
+        self._resources = resources
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+        self.server_close()
+
+    def __exit__(self, *args: list) -> None:
+        self.close()